@@ -2,38 +2,166 @@
 Scan JPG images from data folder and create Excel sheet with metadata.
 """
 
+import io
+import math
 import os
+import struct
+from collections import deque
+from contextlib import redirect_stderr, redirect_stdout
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
-from PIL import Image
-from PIL.ExifTags import TAGS
-import openpyxl
+import cv2
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
 
-from water_meter_detector import detect_water_meter_type, extract_meter_reading, extract_meter_display
+from water_meter_detector import detect_water_meter_type, extract_meter_reading, extract_meter_display, open_image
 
+# Configuration
+DEBUG_OUTPUT = True  # Set to True to see detailed debug information
+SAVE_METER_DISPLAYS = True  # Save extracted meter display regions
+DISPLAYS_FOLDER = Path('results/meter_displays')
+MAX_BATCH_SIZE = 8  # Most images handed to a worker process at a time
+READ_AHEAD = 4  # Files each worker reads in the background while processing
 
-def get_image_datetime(image_path):
+# EXIF tag ids looked up by get_image_datetime
+DATETIME_TAG_ID = 0x0132  # DateTime (IFD0)
+EXIF_IFD_POINTER_TAG_ID = 0x8769  # Offset of the Exif sub-IFD (IFD0)
+EXIF_DATETIME_TAG_IDS = (0x9003, 0x9004)  # DateTimeOriginal, DateTimeDigitized (Exif sub-IFD)
+
+
+def _read_exif_segment(f):
+    """
+    Read only the EXIF (APP1) segment from the JPEG header, without
+    decoding the image.
+    
+    Args:
+        f: Binary file object positioned at the start of the JPEG
+        
+    Returns:
+        TIFF-formatted EXIF bytes, or None if the file has no EXIF segment
+    """
+    if f.read(2) != b'\xff\xd8':
+        return None
+    
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        
+        # Start of scan / end of image: no more metadata segments
+        if marker[1] in (0xDA, 0xD9):
+            return None
+        
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            return None
+        length = struct.unpack('>H', length_bytes)[0]
+        
+        if marker[1] == 0xE1:
+            segment = f.read(length - 2)
+            if segment.startswith(b'Exif\x00\x00'):
+                return segment[6:]
+        else:
+            f.seek(length - 2, os.SEEK_CUR)
+
+
+def _parse_ifd(tiff, offset, byte_order):
+    """
+    Parse a TIFF IFD into a dict of tag id -> (type, count, raw value/offset).
+    """
+    count = struct.unpack_from(byte_order + 'H', tiff, offset)[0]
+    entries = {}
+    for i in range(count):
+        tag, typ, n, value = struct.unpack_from(byte_order + 'HHI4s', tiff, offset + 2 + i * 12)
+        entries[tag] = (typ, n, value)
+    return entries
+
+
+def _ascii_value(tiff, entry, byte_order):
+    """
+    Decode an ASCII IFD entry to a string.
+    """
+    typ, n, value = entry
+    if typ != 2:
+        return None
+    if n <= 4:
+        raw = value[:n]
+    else:
+        offset = struct.unpack(byte_order + 'I', value)[0]
+        raw = tiff[offset:offset + n]
+    return raw.rstrip(b'\x00').decode('ascii', errors='replace') or None
+
+
+def _get_image_datetime_pil(image_path, data=None):
+    """
+    Fallback for files the header parser cannot find EXIF in: let PIL
+    locate the EXIF block and look up only the datetime tags by id.
+    
+    Args:
+        image_path: Path to the image file
+        data: Optional raw file contents (avoids reading the file again)
+        
+    Returns:
+        Formatted datetime string or None if no EXIF data found
+    """
+    with open_image(image_path, data) as image:
+        exif = image.getexif()
+    
+    value = exif.get(DATETIME_TAG_ID)
+    if value:
+        return value
+    
+    exif_ifd = exif.get_ifd(EXIF_IFD_POINTER_TAG_ID)
+    for tag_id in EXIF_DATETIME_TAG_IDS:
+        value = exif_ifd.get(tag_id)
+        if value:
+            return value
+    
+    return None
+
+
+def get_image_datetime(image_path, data=None):
     """
     Extract the date and time when the image was taken from EXIF metadata.
+    Only the JPEG header is parsed; the image itself is never decoded.
     
     Args:
         image_path: Path to the image file
+        data: Optional raw file contents (avoids reading the file again)
         
     Returns:
         Formatted datetime string or None if no EXIF data found
     """
     try:
-        image = Image.open(image_path)
-        exif_data = image._getexif()
+        if data is not None:
+            tiff = _read_exif_segment(io.BytesIO(data))
+        else:
+            with open(image_path, 'rb') as f:
+                tiff = _read_exif_segment(f)
+        if tiff is None:
+            return _get_image_datetime_pil(image_path, data)
         
-        if exif_data is not None:
-            for tag_id, value in exif_data.items():
-                tag = TAGS.get(tag_id, tag_id)
-                
-                # Look for DateTime or DateTimeOriginal
-                if tag in ['DateTime', 'DateTimeOriginal', 'DateTimeDigitized']:
-                    return value
+        byte_order = '<' if tiff[:2] == b'II' else '>'
+        ifd0_offset = struct.unpack_from(byte_order + 'I', tiff, 4)[0]
+        ifd0 = _parse_ifd(tiff, ifd0_offset, byte_order)
+        
+        # DateTime lives in IFD0
+        if DATETIME_TAG_ID in ifd0:
+            value = _ascii_value(tiff, ifd0[DATETIME_TAG_ID], byte_order)
+            if value:
+                return value
+        
+        # DateTimeOriginal / DateTimeDigitized live in the Exif sub-IFD
+        if EXIF_IFD_POINTER_TAG_ID in ifd0:
+            exif_offset = struct.unpack(byte_order + 'I', ifd0[EXIF_IFD_POINTER_TAG_ID][2])[0]
+            exif_ifd = _parse_ifd(tiff, exif_offset, byte_order)
+            for tag_id in EXIF_DATETIME_TAG_IDS:
+                if tag_id in exif_ifd:
+                    value = _ascii_value(tiff, exif_ifd[tag_id], byte_order)
+                    if value:
+                        return value
         
         return None
     except Exception as e:
@@ -41,34 +169,128 @@ def get_image_datetime(image_path):
         return None
 
 
+def init_worker():
+    """
+    Initialize a worker process. Each worker handles one image at a time,
+    so OpenCV's own thread pool would only oversubscribe the CPU.
+    """
+    cv2.setNumThreads(1)
+
+
+def read_file(image_path):
+    """
+    Read a file's contents without letting a bad file abort the run.
+    
+    Args:
+        image_path: Path to the file
+        
+    Returns:
+        File contents, or None if the file could not be read (the
+        extraction steps then read from disk and report the error themselves)
+    """
+    try:
+        return image_path.read_bytes()
+    except OSError:
+        return None
+
+
+def read_ahead(image_paths, depth=READ_AHEAD):
+    """
+    Read files in background threads, up to depth files ahead of the
+    consumer, so disk/network latency overlaps with image processing.
+    
+    Args:
+        image_paths: Paths of the files to read
+        depth: Maximum number of files being read ahead
+        
+    Yields:
+        Tuples of (image_path, file contents or None if unreadable), in input order
+    """
+    with ThreadPoolExecutor(max_workers=depth) as pool:
+        pending = deque()
+        for image_path in image_paths:
+            pending.append((image_path, pool.submit(read_file, image_path)))
+            if len(pending) > depth:
+                path, future = pending.popleft()
+                yield path, future.result()
+        
+        while pending:
+            path, future = pending.popleft()
+            yield path, future.result()
+
+
+def process_one(image_path, data=None):
+    """
+    Extract metadata, meter type and reading from a single image.
+    Runs in a worker process, so it must not touch the workbook.
+    Debug and error output is captured and returned instead of printed, so
+    output from workers running in parallel does not interleave.
+    
+    Args:
+        image_path: Path to the image file
+        data: Optional raw file contents, if already read
+        
+    Returns:
+        Tuple of (filename, datetime_taken, meter_type, meter_reading, output)
+    """
+    filename = image_path.name
+    output = io.StringIO()
+    
+    with redirect_stdout(output), redirect_stderr(output):
+        # Read the file once and share the contents between all extraction steps
+        if data is None:
+            data = read_file(image_path)
+        
+        datetime_taken = get_image_datetime(image_path, data)
+        meter_type = detect_water_meter_type(image_path, debug=DEBUG_OUTPUT, data=data)
+        meter_reading = extract_meter_reading(
+            image_path, 
+            debug=DEBUG_OUTPUT, 
+            save_display=SAVE_METER_DISPLAYS,
+            output_folder=DISPLAYS_FOLDER if SAVE_METER_DISPLAYS else None,
+            data=data
+        )
+    
+    return filename, datetime_taken, meter_type, meter_reading, output.getvalue()
+
+
+def process_batch(image_paths):
+    """
+    Process a batch of images in a worker process, reading the next files
+    ahead while the current one is being processed.
+    
+    Args:
+        image_paths: List of image file paths
+        
+    Returns:
+        List of process_one results, in input order
+    """
+    return [process_one(image_path, data) for image_path, data in read_ahead(image_paths)]
+
+
 def scan_images_to_excel():
     """
     Scan JPG images from data folder and create Excel sheet with metadata.
     """
-    # Configuration
-    DEBUG_OUTPUT = True  # Set to True to see detailed debug information
-    SAVE_METER_DISPLAYS = True  # Save extracted meter display regions
-    
     # Define paths
     data_folder = Path('data')
     results_folder = Path('results')
-    displays_folder = Path('results/meter_displays')
     
     # Create results folder if it doesn't exist
     results_folder.mkdir(exist_ok=True)
     
     # Create meter displays folder if saving displays
     if SAVE_METER_DISPLAYS:
-        displays_folder.mkdir(exist_ok=True)
+        DISPLAYS_FOLDER.mkdir(exist_ok=True)
     
-    # Get all JPG files from data folder (case-insensitive)
+    # Get all JPG files from data folder (case-insensitive) in a single directory scan
     jpg_files = []
-    seen_files = set()
-    for pattern in ['*.jpg', '*.JPG', '*.jpeg', '*.JPEG']:
-        for file_path in data_folder.glob(pattern):
-            if file_path.name.lower() not in seen_files:
-                jpg_files.append(file_path)
-                seen_files.add(file_path.name.lower())
+    if data_folder.is_dir():
+        jpg_files = [
+            Path(entry.path)
+            for entry in os.scandir(data_folder)
+            if entry.is_file() and entry.name.lower().endswith(('.jpg', '.jpeg'))
+        ]
     
     if not jpg_files:
         print("No JPG files found in data folder.")
@@ -77,50 +299,46 @@ def scan_images_to_excel():
     # Sort files by name
     jpg_files.sort()
     
-    # Create Excel workbook
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Image Metadata"
-    
-    # Add headers
-    ws['A1'] = 'File Name'
-    ws['B1'] = 'Date and Time Taken'
-    ws['C1'] = 'Meter Type'
-    ws['D1'] = 'Reading (m³)'
-    
-    # Make headers bold
-    ws['A1'].font = openpyxl.styles.Font(bold=True)
-    ws['B1'].font = openpyxl.styles.Font(bold=True)
-    ws['C1'].font = openpyxl.styles.Font(bold=True)
-    ws['D1'].font = openpyxl.styles.Font(bold=True)
-    
-    # Process each image
-    row = 2
-    for image_path in jpg_files:
-        filename = image_path.name
-        datetime_taken = get_image_datetime(image_path)
-        meter_type = detect_water_meter_type(image_path, debug=DEBUG_OUTPUT)
-        meter_reading = extract_meter_reading(
-            image_path, 
-            debug=DEBUG_OUTPUT, 
-            save_display=SAVE_METER_DISPLAYS,
-            output_folder=displays_folder if SAVE_METER_DISPLAYS else None
-        )
-        
-        ws[f'A{row}'] = filename
-        ws[f'B{row}'] = datetime_taken if datetime_taken else 'No EXIF data'
-        ws[f'C{row}'] = meter_type
-        ws[f'D{row}'] = meter_reading if meter_reading else 'N/A'
-        
-        print(f"Processed: {filename} - {meter_type} - Reading: {meter_reading if meter_reading else 'N/A'}")
-        row += 1
+    # Create Excel workbook in write-only mode so rows are streamed to disk
+    # instead of keeping every Cell object in memory
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Image Metadata")
     
-    # Auto-adjust column widths
+    # Set column widths (must happen before any row is written)
     ws.column_dimensions['A'].width = 30
     ws.column_dimensions['B'].width = 25
     ws.column_dimensions['C'].width = 15
     ws.column_dimensions['D'].width = 15
     
+    # Add bold headers
+    bold_font = Font(bold=True)
+    headers = []
+    for title in ['File Name', 'Date and Time Taken', 'Meter Type', 'Reading (m³)']:
+        cell = WriteOnlyCell(ws, value=title)
+        cell.font = bold_font
+        headers.append(cell)
+    ws.append(headers)
+    
+    # Process images in parallel; rows are written on the main process only
+    # because openpyxl is not safe to share across processes
+    # Spread small folders over all cores; cap the batch size for large ones
+    batch_size = min(MAX_BATCH_SIZE, math.ceil(len(jpg_files) / (os.cpu_count() or 1)))
+    batches = [jpg_files[i:i + batch_size] for i in range(0, len(jpg_files), batch_size)]
+    
+    with ProcessPoolExecutor(initializer=init_worker) as executor:
+        for results in executor.map(process_batch, batches):
+            for filename, datetime_taken, meter_type, meter_reading, output in results:
+                ws.append((
+                    filename,
+                    datetime_taken if datetime_taken else 'No EXIF data',
+                    meter_type,
+                    meter_reading if meter_reading else 'N/A',
+                ))
+                
+                # Print each image's debug output together with its result
+                print(output, end='')
+                print(f"Processed: {filename} - {meter_type} - Reading: {meter_reading if meter_reading else 'N/A'}")
+    
     # Create output filename with current date
     current_date = datetime.now().strftime('%Y.%m.%dT%H.%M')
     output_filename = f"{current_date}__images.xlsx"
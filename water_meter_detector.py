@@ -2,6 +2,7 @@
 Water meter type detection and reading extraction using color analysis and OCR.
 """
 
+import io
 import numpy as np
 from PIL import Image
 import pytesseract
@@ -10,14 +11,156 @@ import re
 import os
 from pathlib import Path
 
-# Configure tesseract executable path (Windows default installation)
+try:
+    import tesserocr  # Optional: in-process libtesseract bindings
+except ImportError:
+    tesserocr = None
+
+try:
+    from numba import njit  # Optional: compiled meter type classification
+except ImportError:
+    njit = None
+
+# Configure tesseract executable and language data paths (Windows default installation)
+tessdata_path = None
 if os.name == 'nt':  # Windows
     tesseract_path = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
     if os.path.exists(tesseract_path):
         pytesseract.pytesseract.tesseract_cmd = tesseract_path
+        tessdata_path = r'C:\Program Files\Tesseract-OCR\tessdata'
+
+# OCR settings shared by both OCR backends
+OCR_PSM_MODES = [7, 8, 13]  # 7=single line, 8=single word, 13=raw line
+OCR_WHITELIST = '0123456789.'
+
+# Hue classification for meter type detection, indexed by OpenCV hue
+# (degrees / 2): +1 for red, -1 for blue, 0 for anything else
+# Red: 345-360° or 0-15° (> 172 or < 8)
+# Blue: 187-259° (94-130)
+HUE_CLASS_LUT = np.zeros(180, np.int8)
+HUE_CLASS_LUT[:8] = 1
+HUE_CLASS_LUT[173:] = 1
+HUE_CLASS_LUT[94:131] = -1
+
+# Only pixels with decent saturation and value count as colored:
+# S > 39 (S >= 40, about 0.157) and V > 63 (V >= 64, about 0.251) on the
+# 0-255 scale. Both cuts sit on HSV_CLASS_LUT bin boundaries, so the
+# quantized table applies them exactly.
+MIN_SATURATION = 39
+MIN_VALUE = 63
+
+# Pixel classes for meter type detection
+PIXEL_UNCOLORED, PIXEL_OTHER, PIXEL_RED, PIXEL_BLUE = 0, 1, 2, 3
+
+# Complete pixel classification indexed by [H, S >> 3, V >> 3] (~180 KB, so
+# it stays cache resident). S and V are quantized to 8 levels per bin; a bin
+# counts as colored if all its values pass MIN_SATURATION / MIN_VALUE.
+HSV_QUANT_SHIFT = 3
+_bin_starts = np.arange(256 >> HSV_QUANT_SHIFT) << HSV_QUANT_SHIFT
+_colored_bins = (_bin_starts[:, None] > MIN_SATURATION) & (_bin_starts[None, :] > MIN_VALUE)
+_hue_classes = np.select(
+    [HUE_CLASS_LUT == 1, HUE_CLASS_LUT == -1], [PIXEL_RED, PIXEL_BLUE], PIXEL_OTHER
+).astype(np.uint8)
+HSV_CLASS_LUT = np.where(_colored_bins[None, :, :], _hue_classes[:, None, None], PIXEL_UNCOLORED).astype(np.uint8)
+
+# Smallest dark area accepted as a display candidate (bounding box, pixels)
+MIN_DISPLAY_WIDTH = 80
+MIN_DISPLAY_HEIGHT = 20
+MIN_DISPLAY_AREA = 2000
+
+# Size of the closing kernel that joins display pixels into one area
+CLOSE_KERNEL_SIZE = 10
+
+# Display detection is skipped when the dark mask has too few pixels to form
+# a candidate, or covers more than this fraction of the center crop
+# (underexposed). After closing, every dark pixel grows to at most a
+# CLOSE_KERNEL_SIZE square, so a candidate wider than MIN_DISPLAY_WIDTH needs
+# at least ceil((MIN_DISPLAY_WIDTH + 1) / CLOSE_KERNEL_SIZE) dark pixels.
+DARK_MASK_MIN_PIXELS = (MIN_DISPLAY_WIDTH + CLOSE_KERNEL_SIZE) // CLOSE_KERNEL_SIZE
+DARK_MASK_MAX_FRACTION = 0.6
+
+# Number of digits in a complete reading; OCR stops once one is found
+FULL_READING_DIGITS = 6
+
+# OCR preprocessing helpers, created once instead of per image
+CLAHE = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
+SHARPEN_KERNEL = np.array([[-1,-1,-1], [-1,9,-1], [-1,-1,-1]])
 
+# One tesserocr API per PSM mode, created on first use and kept alive for
+# the whole run so the tesseract models are only loaded once per process.
+# _use_tesserocr is switched off if tesserocr cannot initialize, so pytesseract is used instead.
+_tesserocr_apis = {}
+_use_tesserocr = tesserocr is not None
 
-def extract_meter_display(image_path, output_folder=None, debug=False):
+
+if njit is not None:
+    @njit(cache=True)
+    def _count_pixel_classes(hsv, hsv_class_lut, shift):
+        """
+        Count the pixels of each HSV_CLASS_LUT class in a single pass.
+        
+        Args:
+            hsv: uint8 HSV image (OpenCV scale)
+            hsv_class_lut: HSV_CLASS_LUT
+            shift: HSV_QUANT_SHIFT
+            
+        Returns:
+            Array of pixel counts indexed by class
+        """
+        counts = np.zeros(4, np.int64)
+        for i in range(hsv.shape[0]):
+            for j in range(hsv.shape[1]):
+                counts[hsv_class_lut[hsv[i, j, 0], hsv[i, j, 1] >> shift, hsv[i, j, 2] >> shift]] += 1
+        return counts
+else:
+    _count_pixel_classes = None
+
+
+def _hot_cold_counts(bgr):
+    """
+    Count colored, red and blue pixels of an image.
+    This is the only numerical routine behind meter type detection.
+    
+    Args:
+        bgr: uint8 BGR image as returned by OpenCV
+        
+    Returns:
+        Tuple of (colored, red, blue) pixel counts
+    """
+    # Convert to HSV in OpenCV (uint8: H in 0-179, S and V in 0-255)
+    hsv = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV)
+    
+    if _count_pixel_classes is not None:
+        # Single fused pass over the HSV buffer, no intermediate arrays
+        counts = _count_pixel_classes(hsv, HSV_CLASS_LUT, HSV_QUANT_SHIFT)
+    else:
+        # One table gather classifies every pixel, one bincount tallies them
+        pixel_class = HSV_CLASS_LUT[
+            hsv[:, :, 0], hsv[:, :, 1] >> HSV_QUANT_SHIFT, hsv[:, :, 2] >> HSV_QUANT_SHIFT
+        ]
+        counts = np.bincount(pixel_class.ravel(), minlength=4)
+    
+    colored = int(counts[PIXEL_OTHER] + counts[PIXEL_RED] + counts[PIXEL_BLUE])
+    return colored, int(counts[PIXEL_RED]), int(counts[PIXEL_BLUE])
+
+
+def open_image(image_path, data=None):
+    """
+    Open an image either from already-read file contents or from disk.
+    
+    Args:
+        image_path: Path to the image file
+        data: Optional raw file contents, so the file is only read once
+        
+    Returns:
+        PIL Image
+    """
+    if data is not None:
+        return Image.open(io.BytesIO(data))
+    return Image.open(image_path)
+
+
+def extract_meter_display(image_path, output_folder=None, debug=False, data=None):
     """
     Extract the meter display region from the center of the image.
     Uses color detection to find the dark display area surrounded by lighter meter body.
@@ -26,14 +169,15 @@ def extract_meter_display(image_path, output_folder=None, debug=False):
         image_path: Path to the image file
         output_folder: Optional folder to save extracted display images
         debug: Print debug information
+        data: Optional raw file contents (avoids reading the file again)
         
     Returns:
         numpy array of the extracted meter display region, or None if failed
     """
     try:
         # Open and read the image
-        image = Image.open(image_path)
-        img_array = np.array(image)
+        image = open_image(image_path, data)
+        img_array = np.asarray(image)
         
         # Get image dimensions
         height, width = img_array.shape[:2]
@@ -50,7 +194,7 @@ def extract_meter_display(image_path, output_folder=None, debug=False):
         if len(rough_cropped.shape) == 2:
             rough_cropped_rgb = cv2.cvtColor(rough_cropped, cv2.COLOR_GRAY2RGB)
         else:
-            rough_cropped_rgb = rough_cropped.copy()
+            rough_cropped_rgb = rough_cropped  # cv2.inRange does not modify its input
         
         # Look for the very dark digital display area (almost black background with dark numbers)
         # The display background is around RGB #2f302a to #454135 (47-69 range)
@@ -62,38 +206,56 @@ def extract_meter_display(image_path, output_folder=None, debug=False):
         dark_upper = np.array([85, 85, 80])  # Wider range above
         dark_mask = cv2.inRange(rough_cropped_rgb, dark_lower, dark_upper)
         
-        # Apply morphological operations to clean up and connect display pixels
-        kernel_small = np.ones((3, 3), np.uint8)
-        kernel_large = np.ones((10, 10), np.uint8)
-        dark_mask = cv2.morphologyEx(dark_mask, cv2.MORPH_CLOSE, kernel_large)
-        dark_mask = cv2.morphologyEx(dark_mask, cv2.MORPH_OPEN, kernel_small)
-        
-        # Find contours of dark areas
-        contours, _ = cv2.findContours(dark_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        
         best_display = None
-        best_score = 0
         
-        if contours:
-            # Find best rectangular contour that looks like a digital display
-            for contour in contours:
-                x, y, w, h = cv2.boundingRect(contour)
+        # Masks too sparse to contain a candidate (overexposed) or nearly full
+        # (underexposed) go straight to the fallback crop
+        dark_pixels = cv2.countNonZero(dark_mask)
+        mask_area = dark_mask.shape[0] * dark_mask.shape[1]
+        if DARK_MASK_MIN_PIXELS <= dark_pixels <= DARK_MASK_MAX_FRACTION * mask_area:
+            # Apply morphological operations to clean up and connect display pixels
+            kernel_small = np.ones((3, 3), np.uint8)
+            kernel_large = np.ones((CLOSE_KERNEL_SIZE, CLOSE_KERNEL_SIZE), np.uint8)
+            dark_mask = cv2.morphologyEx(dark_mask, cv2.MORPH_CLOSE, kernel_large)
+            dark_mask = cv2.morphologyEx(dark_mask, cv2.MORPH_OPEN, kernel_small)
+            
+            # Fill holes so areas nested inside another area's hole are merged
+            # into it: only outermost areas are candidates, as with external contours
+            outside = cv2.copyMakeBorder(dark_mask, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+            cv2.floodFill(outside, None, (0, 0), 255)
+            filled_mask = cv2.bitwise_or(dark_mask, cv2.bitwise_not(outside[1:-1, 1:-1]))
+            
+            # Find connected dark areas with their bounding boxes (x, y, w, h, area)
+            num_labels, _, stats, _ = cv2.connectedComponentsWithStats(filled_mask, connectivity=8)
+            
+            if num_labels > 1:
+                # Score all candidate regions at once (label 0 is the background)
+                x = stats[1:, cv2.CC_STAT_LEFT]
+                y = stats[1:, cv2.CC_STAT_TOP]
+                w = stats[1:, cv2.CC_STAT_WIDTH].astype(np.int64)
+                h = stats[1:, cv2.CC_STAT_HEIGHT].astype(np.int64)
                 area = w * h
                 
                 # Digital displays are typically wider than tall (landscape orientation)
                 # And should be reasonably sized (at least 100x30 pixels or so)
-                if w > 80 and h > 20 and area > 2000:
-                    # Calculate aspect ratio (width/height) - display should be 2:1 to 5:1
-                    aspect_ratio = w / h
-                    
+                # Aspect ratio (width/height) - display should be 2:1 to 5:1
+                aspect_ratio = w / h
+                valid = (
+                    (w > MIN_DISPLAY_WIDTH) & (h > MIN_DISPLAY_HEIGHT) & (area > MIN_DISPLAY_AREA)
+                    & (aspect_ratio > 2.0) & (aspect_ratio < 6.0)
+                )
+                
+                if valid.any():
                     # Score based on aspect ratio and size
-                    # Prefer aspect ratios between 2.5 and 4.5
-                    if 2.0 < aspect_ratio < 6.0:
-                        score = area * (1.0 / abs(aspect_ratio - 3.5) if aspect_ratio != 3.5 else area)
-                        
-                        if score > best_score:
-                            best_score = score
-                            best_display = (x, y, w, h)
+                    # Prefer aspect ratios close to 3.5
+                    deviation = np.abs(aspect_ratio - 3.5)
+                    score = np.where(deviation == 0, area * area, area / np.where(deviation == 0, 1.0, deviation))
+                    score = np.where(valid, score, -np.inf)
+                    
+                    best = int(np.argmax(score))
+                    best_display = (int(x[best]), int(y[best]), int(w[best]), int(h[best]))
+        elif debug:
+            print(f"  Dark area covers {dark_pixels * 100 / max(mask_area, 1):.1f}% of the center, skipping display detection")
         
         if best_display:
             x, y, w, h = best_display
@@ -134,9 +296,17 @@ def extract_meter_display(image_path, output_folder=None, debug=False):
             stem = Path(image_path).stem
             output_file = output_path / f"{stem}_display.jpg"
             
-            # Save as image
-            display_image = Image.fromarray(meter_display)
-            display_image.save(output_file)
+            # Save as image with OpenCV's JPEG encoder (expects BGR channel order)
+            if meter_display.ndim == 3:
+                display_bgr = cv2.cvtColor(meter_display, cv2.COLOR_RGB2BGR)
+            else:
+                display_bgr = meter_display
+            # Encode in memory and write with pathlib: cv2.imwrite fails silently
+            # and cannot handle non-ASCII paths on Windows
+            ok, encoded = cv2.imencode('.jpg', display_bgr, [cv2.IMWRITE_JPEG_QUALITY, 90])
+            if not ok:
+                raise ValueError(f"could not encode meter display for {output_file}")
+            output_file.write_bytes(encoded.tobytes())
             
             if debug:
                 print(f"  Saved meter display: {output_file}")
@@ -149,7 +319,7 @@ def extract_meter_display(image_path, output_folder=None, debug=False):
         return None
 
 
-def detect_water_meter_type(image_path, debug=False):
+def detect_water_meter_type(image_path, debug=False, data=None):
     """
     Detect if the water meter image is for hot water (red) or cold water (blue).
     Uses HSV color space to detect hue.
@@ -157,64 +327,25 @@ def detect_water_meter_type(image_path, debug=False):
     Args:
         image_path: Path to the image file
         debug: Print debug information
+        data: Optional raw file contents (avoids reading the file again)
         
     Returns:
         'Hot Water' if red dominates, 'Cold Water' if blue dominates
     """
     try:
-        # Open image and convert to RGB, resize for faster processing
-        image = Image.open(image_path)
-        image = image.resize((800,600))  # Resize for speed
-        image = image.convert('RGB')
-        
-        # Convert to numpy array (uint8 0-255)
-        img_array = np.array(image).astype(float)
-        
-        # Extract RGB channels
-        r = img_array[:, :, 0] / 255.0
-        g = img_array[:, :, 1] / 255.0
-        b = img_array[:, :, 2] / 255.0
-        
-        # Compute HSV components (vectorized)
-        max_c = np.maximum(np.maximum(r, g), b)
-        min_c = np.minimum(np.minimum(r, g), b)
-        diff = max_c - min_c
-        
-        # Saturation
-        saturation = np.where(max_c == 0, 0, diff / max_c)
-        
-        # Value
-        value = max_c
-        
-        # Hue (0-1 scale)
-        hue = np.zeros_like(max_c)
-        
-        # Red dominant
-        mask = (max_c == r)
-        hue[mask] = (60 * ((g[mask] - b[mask]) / (diff[mask] + 1e-10)) + 360) % 360
-        
-        # Green dominant
-        mask = (max_c == g)
-        hue[mask] = (60 * ((b[mask] - r[mask]) / (diff[mask] + 1e-10)) + 120)
-        
-        # Blue dominant
-        mask = (max_c == b)
-        hue[mask] = (60 * ((r[mask] - g[mask]) / (diff[mask] + 1e-10)) + 240)
-        
-        hue = hue / 360.0  # Convert to 0-1 scale
-        
-        # Only consider pixels with decent saturation and value (colored pixels)
-        colored_mask = (saturation > 0.15) & (value > 0.25)
-        
-        # Hue ranges (in 0-1 scale, hue in degrees / 360):
-        # Red: 345-360° (0.958-1.0) or 0-15° (0-0.042)
-        # Blue: 200-250° (0.556-0.694)
-        red_mask = colored_mask & ((hue < 0.042) | (hue > 0.958))
-        blue_mask = colored_mask & (hue >= 0.52) & (hue <= 0.72)
+        # Decode at 1/4 resolution: the JPEG decoder downscales during the
+        # IDCT, so the full-resolution image is never materialized
+        # (np.fromfile + imdecode rather than cv2.imread, which cannot open
+        # non-ASCII paths on Windows)
+        if data is not None:
+            buffer = np.frombuffer(data, np.uint8)
+        else:
+            buffer = np.fromfile(image_path, np.uint8)
+        bgr = cv2.imdecode(buffer, cv2.IMREAD_REDUCED_COLOR_4)
+        if bgr is None:
+            raise ValueError("could not decode image")
         
-        red_pixel_count = np.sum(red_mask)
-        blue_pixel_count = np.sum(blue_mask)
-        total_colored = np.sum(colored_mask)
+        total_colored, red_pixel_count, blue_pixel_count = _hot_cold_counts(bgr)
         
         if debug:
             print(f"  Debug {image_path.name}: colored={total_colored}, red={red_pixel_count}({red_pixel_count*100/max(total_colored,1):.1f}%), blue={blue_pixel_count}({blue_pixel_count*100/max(total_colored,1):.1f}%)")
@@ -234,7 +365,77 @@ def detect_water_meter_type(image_path, debug=False):
         return 'Unknown'
 
 
-def extract_meter_reading(image_path, debug=False, save_display=False, output_folder=None):
+def run_ocr(image, psm):
+    """
+    Run OCR on a preprocessed image with the digit whitelist.
+    Uses tesserocr (no subprocess) when installed, otherwise pytesseract.
+    
+    Args:
+        image: numpy array of the preprocessed (grayscale) image
+        psm: Tesseract page segmentation mode
+        
+    Returns:
+        Recognized text
+    """
+    global _use_tesserocr
+    
+    if _use_tesserocr:
+        api = _tesserocr_apis.get(psm)
+        if api is None:
+            kwargs = {'path': tessdata_path} if tessdata_path else {}
+            try:
+                api = tesserocr.PyTessBaseAPI(
+                    psm=psm,
+                    oem=tesserocr.OEM.DEFAULT,
+                    variables={'tessedit_char_whitelist': OCR_WHITELIST},
+                    **kwargs
+                )
+            except RuntimeError as e:
+                print(f"tesserocr could not be initialized ({e}), falling back to pytesseract")
+                _use_tesserocr = False
+            else:
+                _tesserocr_apis[psm] = api
+        
+        if api is not None:
+            api.SetImage(Image.fromarray(image))
+            return api.GetUTF8Text()
+    
+    config = f'--oem 3 --psm {psm} -c tessedit_char_whitelist={OCR_WHITELIST}'
+    return pytesseract.image_to_string(image, config=config)
+
+
+def preprocess_for_ocr(gray):
+    """
+    Generate the OCR preprocessing variants of a grayscale display image,
+    ordered by how often they produce the reading. Each variant is computed
+    only when requested and all variants share one output buffer, so a
+    yielded image is only valid until the next one is requested.
+    
+    Args:
+        gray: Grayscale meter display image
+        
+    Yields:
+        Tuples of (method name, preprocessed image)
+    """
+    buffer = np.empty_like(gray)
+    
+    # Contrast enhancement with CLAHE
+    yield 'clahe', CLAHE.apply(gray, dst=buffer)
+    
+    # Simple threshold
+    yield 'otsu', cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=buffer)[1]
+    
+    # Original grayscale
+    yield 'original', gray
+    
+    # Inverted (black background, white numbers)
+    yield 'inverted', cv2.bitwise_not(gray, dst=buffer)
+    
+    # Sharpened
+    yield 'sharpened', cv2.filter2D(gray, -1, SHARPEN_KERNEL, dst=buffer)
+
+
+def extract_meter_reading(image_path, debug=False, save_display=False, output_folder=None, data=None):
     """
     Extract the meter reading from a water meter image using OCR.
     
@@ -243,6 +444,7 @@ def extract_meter_reading(image_path, debug=False, save_display=False, output_fo
         debug: Print debug information
         save_display: Save the extracted meter display region
         output_folder: Folder to save extracted displays (if save_display=True)
+        data: Optional raw file contents (avoids reading the file again)
         
     Returns:
         String containing the meter reading (e.g., "00118.664") or None if not found
@@ -250,9 +452,9 @@ def extract_meter_reading(image_path, debug=False, save_display=False, output_fo
     try:
         # First extract the meter display region
         if save_display and output_folder:
-            meter_display = extract_meter_display(image_path, output_folder, debug)
+            meter_display = extract_meter_display(image_path, output_folder, debug, data)
         else:
-            meter_display = extract_meter_display(image_path, None, debug)
+            meter_display = extract_meter_display(image_path, None, debug, data)
         
         if meter_display is None:
             return None
@@ -271,39 +473,15 @@ def extract_meter_reading(image_path, debug=False, save_display=False, output_fo
             new_height = int(height * scale)
             gray = cv2.resize(gray, (new_width, new_height), interpolation=cv2.INTER_CUBIC)
         
-        # Try multiple preprocessing approaches
-        processed_images = []
-        
-        # 1. Original grayscale
-        processed_images.append(('original', gray))
-        
-        # 2. Contrast enhancement with CLAHE
-        clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
-        enhanced = clahe.apply(gray)
-        processed_images.append(('clahe', enhanced))
-        
-        # 3. Simple threshold
-        _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        processed_images.append(('otsu', thresh))
-        
-        # 4. Inverted (black background, white numbers)
-        inverted = cv2.bitwise_not(gray)
-        processed_images.append(('inverted', inverted))
-        
-        # 5. Sharpened
-        kernel_sharpen = np.array([[-1,-1,-1], [-1,9,-1], [-1,-1,-1]])
-        sharpened = cv2.filter2D(gray, -1, kernel_sharpen)
-        processed_images.append(('sharpened', sharpened))
-        
         # OCR configuration - try multiple PSM modes
         all_readings = []
+        found_full_reading = False
         
-        for method_name, processed in processed_images:
+        for method_name, processed in preprocess_for_ocr(gray):
             # Try different PSM modes
-            for psm in [7, 8, 13]:  # 7=single line, 8=single word, 13=raw line
+            for psm in OCR_PSM_MODES:
                 try:
-                    config = f'--oem 3 --psm {psm} -c tessedit_char_whitelist=0123456789.'
-                    text = pytesseract.image_to_string(processed, config=config)
+                    text = run_ocr(processed, psm)
                     text = text.strip().replace(' ', '').replace(',', '.')
                     
                     if debug and text:
@@ -316,10 +494,20 @@ def extract_meter_reading(image_path, debug=False, save_display=False, output_fo
                         # Valid reading should have at least 3 digits total
                         if len(match.replace('.', '')) >= 3:
                             all_readings.append(match)
+                            
+                            # A long reading with a decimal point is as good as it gets
+                            if '.' in match and len(match.replace('.', '')) >= FULL_READING_DIGITS:
+                                found_full_reading = True
                 except Exception as e:
                     if debug:
                         print(f"    OCR error ({method_name}, PSM {psm}): {e}")
                     continue
+                
+                if found_full_reading:
+                    break
+            
+            if found_full_reading:
+                break
         
         if all_readings:
             # Prioritize longest reading with decimal point